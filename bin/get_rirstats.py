@@ -1,7 +1,9 @@
 """
 This program downloads Internet registry statistics from all five registries and produces CSV output.
 The output comprises all IPv4 and IPv6 ranges. IPv4 ranges are reduced to complete CIDR ranges that represent the
-potentially unaligned ranges in the registry. IPv6 ranges are CIDR-aligned as listed.
+potentially unaligned ranges in the registry; contiguous IPv4 ranges with identical registry, country, date, status,
+and opaque ID are merged first. IPv6 ranges are CIDR-aligned as listed. Set RIRSTATS_GZIP=1 in the environment to
+write the CSV gzip-compressed instead; Splunk itself needs plain CSV, so this is only for running the program directly.
 
 ASNs records are not useful yet because:
   1. AS numbers have 'holders', but that does not necessarily provide information about who or where the IP is used.
@@ -24,13 +26,27 @@ Resource Organization (NRO), the opaque ID is
 """
 
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import csv
 import datetime
-import inspect
+import functools
+import gzip
+import io
 import ipaddress
+import json
 import logging
+import operator
 import os
 import requests
+from requests.adapters import HTTPAdapter
+import socket
 import sys
+import tempfile
+import time
+from typing import Iterable, Iterator
+import urllib.parse
+from urllib3.util import Retry
 
 
 RIRSTATS_URL = [
@@ -42,9 +58,34 @@ RIRSTATS_URL = [
     ]
 
 
+# the largest record count accepted from a version record; the biggest registry file has a few hundred thousand
+MAX_RECORDS = 5000000
+
+
 log = logging.Logger
 
 
+# address families of detail records, stored as integers so that records are cheap to compare
+IPV4 = 0
+IPV6 = 1
+
+# an ipv4 or ipv6 detail record, where start is the first address as an integer so that records sort cheaply
+Record = collections.namedtuple("Record", ["family", "start", "value", "registry", "cc", "date", "status", "opaque_id"])
+
+# a summary record
+Summary = collections.namedtuple("Summary", ["registry", "type", "count"])
+
+
+# a RIR stats file could not be downloaded
+class RIRDownloadError(Exception):
+    pass
+
+
+# a RIR stats file could not be parsed
+class RIRParseError(Exception):
+    pass
+
+
 # define a logger for application messages
 def new_logger(level):
     logger = logging.getLogger('TA-rirstats')
@@ -61,10 +102,34 @@ def new_logger(level):
     return logger
 
 
+# define an HTTP session that reuses connections and retries transient failures
+def new_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=len(RIRSTATS_URL), pool_maxsize=len(RIRSTATS_URL), max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# resolve each registry host only once per run, rather than on every connection, retry, and redirect
+def cache_rir_host_addresses() -> None:
+    hosts = {urllib.parse.urlsplit(url).hostname for url in RIRSTATS_URL}
+    getaddrinfo = socket.getaddrinfo
+    cached_getaddrinfo = functools.lru_cache(maxsize=None)(getaddrinfo)  # failed lookups are not cached
+
+    def rir_getaddrinfo(host, *args, **kwargs):
+        if host in hosts and not kwargs:
+            return cached_getaddrinfo(host, *args)
+        return getaddrinfo(host, *args, **kwargs)
+
+    socket.getaddrinfo = rir_getaddrinfo
+
+
 # format an error log message
 def log_error(msg: str) -> None:
-    # sys.stderr.write(f"{inspect.stack()[1][3]}(): {msg}\n")
-    log.error(f"{inspect.stack()[1][3]}(): {msg}")
+    # sys.stderr.write(f"{sys._getframe(1).f_code.co_name}(): {msg}\n")
+    log.error(f"{sys._getframe(1).f_code.co_name}(): {msg}")  # the caller's name, without inspecting the whole stack
 
 
 # format an informational log message
@@ -87,6 +152,14 @@ def get_date_from_yyyymmdd(text: str) -> datetime.date:
     return result
 
 
+# convert RIR date string to the ISO date string written to the CSV; detail records share a few thousand distinct
+# dates, so remember each conversion instead of building a date object for every record
+@functools.lru_cache(maxsize=None)
+def get_iso_date_from_yyyymmdd(text: str) -> str:
+    date = get_date_from_yyyymmdd(text)
+    return date.isoformat() if date else None
+
+
 # parse a version record and ensure that the version is expected
 def parse_version_record(row: str) -> dict:
     result = {}
@@ -102,7 +175,7 @@ def parse_version_record(row: str) -> dict:
     """
     if not version or 3.0 <= version < 2.0 or len(fields) != 7:
         log_error(f"expected a version 2.x row with seven fields, but got:\n  row = \"{row}\"")
-        exit(1)
+        raise RIRParseError(f"unexpected version row \"{row}\"")
 
     try:
         result["version"] = version
@@ -114,14 +187,21 @@ def parse_version_record(row: str) -> dict:
         result["UTCoffset"] = int(fields[6])
     except Exception as e:
         log_error(f"encountered exception {type(e)}: \"{e}\"\n  row = \"{row}\"")
-        exit(1)
+        raise RIRParseError(f"invalid version row \"{row}\"") from e
+
+    # the record count sizes the parsed record list, so it must be plausible
+    if not 0 <= result["records"] <= MAX_RECORDS:
+        log_error(f"expected between 0 and {MAX_RECORDS} records, but got {result['records']}:\n  row = \"{row}\"")
+        raise RIRParseError(f"implausible record count in version row \"{row}\"")
 
     return result
 
 
-# parse a summary or detail record
-def parse_record(row: str) -> dict:
-    result = {}
+# parse a summary or ipv4/ipv6 detail record into a Summary or Record; other records are ignored
+def parse_record(row: str) -> tuple:
+    # asn detail records are a large share of each file and are ignored, so drop them before splitting the row
+    if "|asn|" in row and not row.endswith("|summary"):
+        return None
     fields = row.split("|")
     if len(fields) < 6:
         log_error(f"row has fewer than six fields; ignoring:\n  row = \"{row}\"")
@@ -130,139 +210,343 @@ def parse_record(row: str) -> dict:
     if fields[5] == "summary":
         # summary records are unused, so it is okay to ignore a parsing error for now
         try:
-            result["registry"] = fields[0]
-            result["type"] = fields[2]
-            result["count"] = int(fields[4])
-            result["summary"] = fields[5]  # should be 'summary'
+            result = Summary(fields[0], fields[2], int(fields[4]))
         except Exception as e:
             log_error(f"encountered exception {type(e)}: \"{e}\"\n  row = \"{row}\"")
             return None
     else:
         try:
-            result["registry"] = fields[0]
-            result["cc"] = fields[1]
-            if fields[2] == "asn":  # maybe useful in the future
-                result["type"] = fields[2]
-                result["start"] = int(fields[3])
-                result["value"] = int(fields[4])
-            elif fields[2] == "ipv4":
-                result["type"] = fields[2]
-                result["start"] = ipaddress.IPv4Address(fields[3])
-                result["value"] = int(fields[4])
+            # inet_pton parses and validates addresses in C, which is much faster than building ipaddress objects
+            value = int(fields[4])
+            if fields[2] == "ipv4":
+                family = IPV4
+                start = int.from_bytes(socket.inet_pton(socket.AF_INET, fields[3]), "big")
+                if value <= 0 or start + value > 1 << 32:  # the range must be non-empty and end within IPv4
+                    raise ValueError(f"{value} addresses from {fields[3]} is not a valid IPv4 range")
             elif fields[2] == "ipv6":
-                result["type"] = fields[2]
-                result["start"] = ipaddress.IPv6Address(fields[3])
-                result["value"] = int(fields[4])
-            result["date"] = get_date_from_yyyymmdd(fields[5])
-            result["status"] = fields[6]
-            if len(fields) >= 8:
-                result["opaque_id"] = fields[7]
-            else:
-                result["opaque_id"] = None
+                family = IPV6
+                start = int.from_bytes(socket.inet_pton(socket.AF_INET6, fields[3]), "big")
+            else:  # asn records are maybe useful in the future
+                return None
+            result = Record(
+                family,
+                start,
+                value,
+                fields[0],
+                fields[1],
+                get_iso_date_from_yyyymmdd(fields[5]),
+                fields[6],
+                fields[7] if len(fields) >= 8 else None
+            )
         except Exception as e:
             log_error(f"encountered exception {type(e)}: \"{e}\"\n  row = \"{row}\"")
-            exit(1)
+            raise RIRParseError(f"invalid detail row \"{row}\"") from e
 
-    if "type" in result and result["type"] in ("ipv4", "ipv6"):
-        return result
-    else:
+    return result
+
+
+# get the directory of cached stats lists
+#   caching is disabled outside Splunk, since a shared location such as the temp directory could be planted by another
+#   user; None is returned in that case
+def get_cache_dir() -> str:
+    splunk_home = os.getenv('SPLUNK_HOME')
+    if splunk_home is None:
         return None
+    return os.path.join(splunk_home, 'var', 'run', 'splunk', 'rirstats')
 
 
-# get a stats list from a URL
-def get_stats_list_from_url(url: str) -> list:
-    result = []
-    log_info(f"starting download of RIR stats from {url}")
+# get the paths of the cached copy of a URL's stats list and of the HTTP validators that were sent with it, or None if
+# caching is disabled
+def get_cache_paths(url: str) -> tuple:
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    name = url.rsplit("/", 1)[-1]
+    return os.path.join(cache_dir, f"{name}.gz"), os.path.join(cache_dir, f"{name}.json")
+
+
+# get conditional request headers from the validators of a cached stats list, so an unchanged file is not downloaded
+def get_cache_headers(body_path: str, validators_path: str) -> dict:
+    headers = {}
+    try:
+        with open(validators_path) as f:
+            validators = json.load(f)
+    except (OSError, ValueError):  # no usable cache
+        return headers
+    if not os.path.isfile(body_path):
+        return headers
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+# remove a cache file; caching is only an optimization, so errors are ignored
+def remove_cache_file(path: str) -> None:
     try:
-        r = requests.get(url)  # all URLs are now HTTP/TLS
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# remove temporary cache files left behind by runs that were killed before they could clean up; a file is stale once
+# it is older than any run could take
+def remove_stale_cache_files() -> None:
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:  # nothing has been cached yet
+        return
+    cutoff = time.time() - 6 * 60 * 60
+    for name in names:
+        if name.endswith(".tmp"):
+            path = os.path.join(cache_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+# create a uniquely named temporary file beside a cache file, so that overlapping runs never write to the same file
+def new_cache_tmp_path(path: str) -> str:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    os.close(fd)
+    return tmp_path
+
+
+# abandon a partly written cached copy of a stats list; caching is only an optimization, so errors are ignored
+def discard_cache(cache: io.BufferedWriter, tmp_path: str) -> None:
+    try:
+        cache.close()
+    except OSError:
+        pass
+    remove_cache_file(tmp_path)
+
+
+# replace the cached copy of a stats list and its validators; the body goes first, so the validators never describe
+# an older copy than the one on disk
+def save_cache(r: requests.Response, cache: io.BufferedWriter, tmp_path: str, body_path: str,
+               validators_path: str) -> None:
+    validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+    try:
+        cache.close()
+    except OSError as e:
+        log_error(f"could not write cached copy of {body_path}: {e}")
+        discard_cache(cache, tmp_path)
+        return
+    try:
+        os.replace(tmp_path, body_path)
+        validators_tmp_path = new_cache_tmp_path(validators_path)
+        with open(validators_tmp_path, "w") as f:
+            json.dump(validators, f)
+        os.replace(validators_tmp_path, validators_path)
+    except OSError as e:
+        log_error(f"could not save cached copy {body_path}: {e}")
+
+
+# request a stats list from a URL, streaming the body
+def request_stats_list(session: requests.Session, url: str, headers: dict) -> requests.Response:
+    try:
+        return session.get(url, headers=headers, stream=True, timeout=(5, 60))  # all URLs are now HTTP/TLS
     except Exception as e:
         log_error(f"encountered exception {type(e)}: \"{e}\"")
-        exit(1)
-    if r.status_code != 200:
-        log_error(f"download of {url} failed with status {r.status_code}")
-        exit(1)
-    for row in r.text.splitlines():
-        row = row.strip()
-        if row[0] == "#":  # skip comment
-            continue
-        elif len(row) == 0:  # skip blank line
-            continue
-        else:
-            result.append(row.rstrip("\n"))
-    log_info(f"completed download of RIR stats; got {len(result)} records")
-    return result
+        raise RIRDownloadError(f"download of {url} failed") from e
+
+
+# get a stats list from a URL, yielding each row as it is downloaded rather than holding the whole file; the kept rows
+# are cached so that a later run can reuse them if the server reports that the file has not changed
+def get_stats_list_from_url(session: requests.Session, url: str) -> Iterator[str]:
+    count = 0
+    cache_paths = get_cache_paths(url)
+    if cache_paths is not None:
+        body_path, validators_path = cache_paths
+        headers = get_cache_headers(body_path, validators_path)
+    else:
+        headers = {}
+    log_info(f"starting download of RIR stats from {url}")
+    r = request_stats_list(session, url, headers)
+    if r.status_code == 304:  # the cached copy is current
+        r.close()
+        log_info(f"RIR stats from {url} are unchanged; using cached copy {body_path}")
+        try:
+            with gzip.open(body_path, "rb") as f:
+                for row in f:
+                    count += 1
+                    yield row.rstrip(b"\n").decode("utf-8", "replace")
+            r = None  # every row came from the cached copy
+        except (OSError, EOFError) as e:
+            log_error(f"could not read cached copy {body_path}: {e}")
+            remove_cache_file(validators_path)  # never send these validators again
+            if count > 0:  # cached rows have already been parsed, so it is too late to download the file instead
+                raise RIRDownloadError(f"cached copy of {url} is unreadable") from e
+            log_info(f"starting download of RIR stats from {url} without the cached copy")
+            r = request_stats_list(session, url, {})
+    if r is not None:
+        if r.status_code != 200:
+            r.close()
+            log_error(f"download of {url} failed with status {r.status_code}")
+            raise RIRDownloadError(f"download of {url} failed with status {r.status_code}")
+        with r:
+            cache = None
+            if cache_paths is not None:
+                tmp_path = None
+                try:
+                    os.makedirs(os.path.dirname(body_path), exist_ok=True)
+                    tmp_path = new_cache_tmp_path(body_path)
+                    # rows are short, so buffer them rather than compressing each one in its own write
+                    cache = io.BufferedWriter(gzip.open(tmp_path, "wb", compresslevel=1), 1 << 20)
+                except OSError as e:  # caching is only an optimization, so carry on without it
+                    log_error(f"could not create cached copy of {body_path}: {e}")
+                    if tmp_path is not None:
+                        remove_cache_file(tmp_path)
+            complete = False
+            try:
+                # filter the raw lines as bytes and decode only the rows that are kept
+                for row in r.iter_lines(chunk_size=64 * 1024):
+                    if len(row) == 0:  # skip blank line
+                        continue
+                    elif row[:1] == b"#":  # skip comment
+                        continue
+                    count += 1
+                    if cache:
+                        try:
+                            cache.write(row + b"\n")
+                        except OSError as e:  # e.g. a full disk; carry on without the cache
+                            log_error(f"could not write cached copy of {body_path}: {e}")
+                            discard_cache(cache, tmp_path)
+                            cache = None
+                    yield row.decode("utf-8", "replace")
+                complete = True
+            except requests.RequestException as e:
+                log_error(f"encountered exception {type(e)}: \"{e}\"")
+                raise RIRDownloadError(f"download of {url} failed") from e
+            finally:
+                if cache:
+                    if complete:
+                        save_cache(r, cache, tmp_path, body_path, validators_path)
+                    else:  # never keep a partial copy
+                        discard_cache(cache, tmp_path)
+    log_info(f"completed download of RIR stats from {url}; got {count} records")
 
 
 # parse a RIR stats record list
-def parse_stats_list(stats_list: list) -> list:
-    result = []
-    v = None
-    count_version = 0
+def parse_stats_list(stats_list: Iterable[str]) -> list:
+    rows = iter(stats_list)
+    v = parse_version_record(next(rows, ""))  # the first real row must be a version record
+    count_version = 1
     count_summary = 0
     count_detail = 0
-    for item in stats_list:
-        if not v:  # the first real row must be a version record
-            v = parse_version_record(item)
-            count_version += 1
-            continue
+    # the version record gives the number of records, so allocate the list once and trim the unused tail at the end
+    result = [None] * v["records"]
+    for item in rows:
         d = parse_record(item)
         if d:
-            if "summary" in d:  # count but don't keep summary record
+            if type(d) is Summary:  # count but don't keep summary record
                 count_summary += 1
-            else:  # count and append detail record
+            else:  # count and keep detail record
+                try:
+                    result[count_detail] = d
+                except IndexError:  # more records than the version record promised
+                    result.append(d)
                 count_detail += 1
-                result.append(d)
+    del result[count_detail:]
     # log_info(f"version={v['version']} detail_expected={v['records']} version_read={count_version} "
     #          f"summary_read={count_summary} detail_read={count_detail}")
     return result
 
 
+# split an IPv4 range of integer addresses into as few CIDR blocks as possible, returning (address, prefix) for each
+def get_ipv4_cidr_blocks(first: int, last: int) -> list:
+    size = last - first + 1
+    if size > 0 and not (size & (size - 1) or first & (size - 1)):  # most ranges are exactly one aligned block
+        return [(first, 33 - size.bit_length())]
+    result = []
+    while first <= last:
+        # a block is limited both by the alignment of its first address and by the number of addresses left
+        nbits = min((first & -first).bit_length() - 1 if first else 32, (last - first + 1).bit_length() - 1)
+        result.append((first, 32 - nbits))
+        first += 1 << nbits
+    return result
+
+
+# merge sorted IPv4 ranges that are contiguous and have identical registration details, yielding (first, last, details)
+# for each merged range; this lets adjacent allocations collapse into fewer, larger CIDR blocks
+def merge_ipv4_ranges(ranges: list) -> Iterator[tuple]:
+    first = next_start = details = None
+    for r in ranges:
+        if r.start == next_start and r[3:] == details:  # r[3:] is (registry, cc, date, status, opaque_id)
+            next_start += r.value
+        else:
+            if details is not None:
+                yield first, next_start - 1, details
+            first, next_start, details = r.start, r.start + r.value, r[3:]
+    if details is not None:
+        yield first, next_start - 1, details
+
+
 # make a CSV from the parsed RIR stats list
 def write_intermediate_stats_to_csv(ranges: list) -> None:
     log_info("started CSV version of RIR stats")
     output_count = 0
-    sys.stdout.write("type,subnet,registry,country,date,status,reg_id\n")
-    sorted_ranges = sorted([i for i in ranges if type(i["start"]) == ipaddress.IPv4Address], key=lambda k: k["start"])
-    sorted_ranges.extend(
-        sorted([i for i in ranges if type(i["start"]) == ipaddress.IPv6Address], key=lambda k: k["start"])
-    )
-    for r in sorted_ranges:
-        if r["type"] == "ipv4":
-            first_address = r["start"]
-            last_address = first_address + (r["value"] - 1)
-            # a v4 range can be unaligned with one CIDR block, so convert to as many CIDR blocks as necessary
-            for rr in ipaddress.summarize_address_range(first_address, last_address):
-                sys.stdout.write(f"{r['type']},"
-                                 f"{rr},"
-                                 f"{r['registry']},"
-                                 f"{r['cc']},"
-                                 f"{r['date'] if r['date'] else ''},"
-                                 f"{r['status']},"
-                                 f"{r['opaque_id'] if r['opaque_id'] else ''}\n")
-                output_count += 1
-        elif r["type"] == "ipv6":
-            sys.stdout.write(f"{r['type']},"
-                             f"{r['start']}/{r['value']},"
-                             f"{r['registry']},"
-                             f"{r['cc']},"
-                             f"{r['date'] if r['date'] else ''},"
-                             f"{r['status']},"
-                             f"{r['opaque_id'] if r['opaque_id'] else ''}\n")
+    if os.getenv("RIRSTATS_GZIP") == "1":  # compress for callers that keep the output; level 1 favors speed
+        output = io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb", compresslevel=1),
+                                  encoding="utf-8", newline="")
+    else:
+        output = sys.stdout
+    writer = csv.writer(output, lineterminator="\n")  # None and empty fields are both written as ''
+    writer.writerow(("type", "subnet", "registry", "country", "date", "status", "reg_id"))
+    # separate the address families in one pass, then sort each on its integer start address
+    ipv4_ranges = []
+    ipv6_ranges = []
+    for r in ranges:
+        if r.family == IPV4:
+            ipv4_ranges.append(r)
+        else:
+            ipv6_ranges.append(r)
+    start_key = operator.attrgetter("start")
+    ipv4_ranges.sort(key=start_key)
+    ipv6_ranges.sort(key=start_key)
+    for first, last, (registry, cc, date, status, opaque_id) in merge_ipv4_ranges(ipv4_ranges):
+        # a v4 range can be unaligned with one CIDR block, so convert to as many CIDR blocks as necessary
+        for address, prefix in get_ipv4_cidr_blocks(first, last):
+            writer.writerow(("ipv4",
+                             f"{address >> 24}.{(address >> 16) & 255}.{(address >> 8) & 255}.{address & 255}"
+                             f"/{prefix}",
+                             registry, cc, date, status, opaque_id))
             output_count += 1
+    for r in ipv6_ranges:
+        writer.writerow(("ipv6", f"{ipaddress.IPv6Address(r.start)}/{r.value}",
+                         r.registry, r.cc, r.date, r.status, r.opaque_id))
+        output_count += 1
+    if output is not sys.stdout:
+        output.close()  # write the gzip trailer; stdout itself is left open
     log_info(f"completed CSV version of RIR stats; wrote {output_count} records")
 
 
+# download and parse the RIR stats from a URL
+def get_ranges_from_url(session: requests.Session, url: str) -> list:
+    return parse_stats_list(get_stats_list_from_url(session, url))
+
+
 # start here
 def main():
     global log
     # create logger
     log = new_logger(logging.INFO)
-    # get and parse RIR stats
+    cache_rir_host_addresses()
+    remove_stale_cache_files()
+    # get and parse RIR stats concurrently, since each download is independent and mostly waiting on the network
     ranges = []
-    for url in RIRSTATS_URL:
-        stats_list = get_stats_list_from_url(url)  # download stats
-        ranges.extend(parse_stats_list(stats_list))  # compile the stats list
-        stats_list.clear()
+    try:
+        with new_session() as session, ThreadPoolExecutor(max_workers=len(RIRSTATS_URL)) as executor:
+            for result in executor.map(functools.partial(get_ranges_from_url, session), RIRSTATS_URL):
+                ranges.extend(result)  # compile the stats lists
+    except (RIRDownloadError, RIRParseError):  # already logged where the error was found
+        exit(1)
     # write CSV to stdout
     write_intermediate_stats_to_csv(ranges)  # write the CSV to stdout
     exit(0)